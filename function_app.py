@@ -1,5 +1,7 @@
+import functools
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import azure.functions as func
 from azure.identity import (
@@ -12,9 +14,19 @@ from update_ocr import process_documents
 
 app = func.FunctionApp()
 
+SECRET_NAMES = {
+    "PAPERLESS_URL": "PAPERLESS-URL",
+    "PAPERLESS_TOKEN": "PAPERLESS-TOKEN",
+    "AZURE_ENDPOINT": "AZURE-ENDPOINT",
+    "AZURE_KEY": "AZURE-KEY",
+    "CF_ACCESS_CLIENT_ID": "CF-ACCESS-CLIENT-ID",
+    "CF_ACCESS_CLIENT_SECRET": "CF-ACCESS-CLIENT-SECRET",
+}
 
-def get_secrets():
-    """Get secrets from Azure Key Vault"""
+
+@functools.lru_cache(maxsize=1)
+def get_secret_client(vault_url):
+    """Create the Key Vault client once per worker so its token cache is reused"""
     is_local_dev = os.environ.get("IS_LOCAL_DEV", "false").lower() == "true"
 
     if is_local_dev:
@@ -24,19 +36,33 @@ def get_secrets():
         logging.info("Running in Azure environment, using Managed Identity credentials")
         credential = ManagedIdentityCredential()
 
-    vault_url = os.environ["vault_url"]
-    secret_client = SecretClient(vault_url=vault_url, credential=credential)
+    return SecretClient(vault_url=vault_url, credential=credential)
+
+
+@functools.lru_cache(maxsize=1)
+def load_secrets(vault_url):
+    """Fetch secrets from Azure Key Vault, cached for the lifetime of the worker"""
+    logging.info("Fetching secrets from Azure Key Vault")
+    secret_client = get_secret_client(vault_url)
+
+    keys = list(SECRET_NAMES)
 
-    return {
-        "PAPERLESS_URL": secret_client.get_secret("PAPERLESS-URL").value,
-        "PAPERLESS_TOKEN": secret_client.get_secret("PAPERLESS-TOKEN").value,
-        "AZURE_ENDPOINT": secret_client.get_secret("AZURE-ENDPOINT").value,
-        "AZURE_KEY": secret_client.get_secret("AZURE-KEY").value,
-        "CF_ACCESS_CLIENT_ID": secret_client.get_secret("CF-ACCESS-CLIENT-ID").value,
-        "CF_ACCESS_CLIENT_SECRET": secret_client.get_secret(
-            "CF-ACCESS-CLIENT-SECRET"
-        ).value,
-    }
+    # Fetch the first secret on its own so the Key Vault auth challenge and
+    # identity token request happen once, then fetch the rest in parallel
+    # with the cached token
+    secrets = {keys[0]: secret_client.get_secret(SECRET_NAMES[keys[0]]).value}
+    with ThreadPoolExecutor(max_workers=len(keys) - 1) as executor:
+        values = executor.map(
+            lambda key: secret_client.get_secret(SECRET_NAMES[key]).value, keys[1:]
+        )
+        secrets.update(zip(keys[1:], values))
+
+    return secrets
+
+
+def get_secrets():
+    """Get secrets from Azure Key Vault"""
+    return load_secrets(os.environ["vault_url"])
 
 
 @app.function_name(name="ProcessPaperlessDocuments")
@@ -49,5 +75,5 @@ def process_paperless_documents(timer: func.TimerRequest) -> None:
         process_documents(secrets)
         logging.info("Processing completed successfully")
     except Exception as e:
-        logging.error(f"Error in processing: {str(e)}")
+        logging.error("Error in processing: %s", e)
         raise
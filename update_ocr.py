@@ -1,8 +1,14 @@
+import functools
 import os
+import orjson
 import requests
 import time
 import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 
 # Setup logging
@@ -13,222 +19,364 @@ from azure.ai.documentintelligence import DocumentIntelligenceClient
 # )
 # logger = logging.getLogger("paperless_azure_ocr")
 
+
+def get_function_timeout_seconds():
+    """
+    Read the host's functionTimeout ([d.]hh:mm:ss) from host.json, falling back
+    to DEFAULT_FUNCTION_TIMEOUT_SECONDS when it is missing, unbounded (-1) or
+    cannot be parsed
+    """
+    try:
+        with open(os.path.join(os.path.dirname(__file__), "host.json"), "rb") as f:
+            function_timeout = orjson.loads(f.read())["functionTimeout"]
+
+        hours, minutes, seconds = function_timeout.split(":")
+        days, _, hours = hours.rpartition(".")
+        return (
+            int(days or 0) * 86400
+            + int(hours) * 3600
+            + int(minutes) * 60
+            + int(float(seconds))
+        )
+    except (OSError, KeyError, ValueError, AttributeError):
+        return DEFAULT_FUNCTION_TIMEOUT_SECONDS
+
+
 # Configuration
 BATCH_SIZE = 10
 CUSTOM_FIELD_ID = 2
+ID_PAGE_SIZE = 1000
+OCR_CONCURRENCY = int(os.environ.get("OCR_CONCURRENCY", "8"))
+# (connect, read) timeout in seconds for every Paperless request, so a hung
+# connection cannot hold a worker past the time budget
+REQUEST_TIMEOUT = (10, 60)
+# Used when host.json sets no usable functionTimeout, the default for
+# Premium and Dedicated plans
+DEFAULT_FUNCTION_TIMEOUT_SECONDS = 30 * 60
+# Stop starting new batches this long before the host's functionTimeout. OCR
+# polls still running are abandoned halfway through it, leaving the rest for
+# the Paperless update of documents already in flight
+RUNTIME_MARGIN_SECONDS = 300
+if "MAX_RUNTIME_SECONDS" in os.environ:
+    MAX_RUNTIME_SECONDS = int(os.environ["MAX_RUNTIME_SECONDS"])
+else:
+    MAX_RUNTIME_SECONDS = get_function_timeout_seconds() - RUNTIME_MARGIN_SECONDS
+
+
+@functools.lru_cache(maxsize=1)
+def get_document_intelligence_client(endpoint, key):
+    """Create the Document Intelligence client once per worker"""
+    kwargs = {}
+
+    # The SDK's default session keeps up to 10 connections alive. With more
+    # worker threads than that, the extra connections would be dropped and
+    # re-established, so give it a session with a pool sized to match. Like
+    # the SDK's own adapter, it leaves retries to the SDK's retry policy.
+    if OCR_CONCURRENCY > 10:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=OCR_CONCURRENCY,
+            max_retries=Retry(total=False, redirect=False, raise_on_status=False),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        kwargs["transport"] = RequestsTransport(session=session, session_owner=False)
+
+    return DocumentIntelligenceClient(
+        endpoint=endpoint,
+        credential=AzureKeyCredential(key),
+        **kwargs,
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_paperless_session(token, cf_access_client_id, cf_access_client_secret):
+    """Create the Paperless session once per worker"""
+    # Share one pooled session for all Paperless calls so connections through
+    # Cloudflare Access are reused instead of renegotiated per request
+    session = requests.Session()
+    # The document PATCH always writes the same content and flag, so it is
+    # idempotent and safe to retry alongside the GETs
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["GET", "PATCH"],
+        raise_on_status=False,
+    )
+    # Size the pool for every worker thread so none of their connections are
+    # dropped and re-established, as for the Document Intelligence session
+    adapter = HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=max(20, OCR_CONCURRENCY),
+        max_retries=retries,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(
+        {
+            "Authorization": f"Token {token}",
+            "Content-Type": "application/json",
+            "CF-Access-Client-Id": cf_access_client_id,
+            "CF-Access-Client-Secret": cf_access_client_secret,
+        }
+    )
+
+    return session
 
 
 def setup_clients(secrets):
     """Initialize clients with provided secrets"""
-    document_intelligence_client = DocumentIntelligenceClient(
-        endpoint=secrets["AZURE_ENDPOINT"],
-        credential=AzureKeyCredential(secrets["AZURE_KEY"]),
+    document_intelligence_client = get_document_intelligence_client(
+        secrets["AZURE_ENDPOINT"], secrets["AZURE_KEY"]
+    )
+    session = get_paperless_session(
+        secrets["PAPERLESS_TOKEN"],
+        secrets["CF_ACCESS_CLIENT_ID"],
+        secrets["CF_ACCESS_CLIENT_SECRET"],
     )
 
-    headers = {
-        "Authorization": f"Token {secrets['PAPERLESS_TOKEN']}",
-        "Content-Type": "application/json",
-        "CF-Access-Client-Id": secrets["CF_ACCESS_CLIENT_ID"],
-        "CF-Access-Client-Secret": secrets["CF_ACCESS_CLIENT_SECRET"],
-    }
-
-    return document_intelligence_client, headers
+    return document_intelligence_client, session
 
 
-def get_custom_field(headers, secrets):
+def get_custom_field(session, secrets):
     """
     Get a custom field by its ID from Paperless
     """
-    logging.info(f"Fetching custom field with ID: {CUSTOM_FIELD_ID}")
+    logging.info("Fetching custom field with ID: %s", CUSTOM_FIELD_ID)
     custom_fields_url = (
         f"{secrets['PAPERLESS_URL']}/api/custom_fields/{CUSTOM_FIELD_ID}/"
     )
-    response = requests.get(custom_fields_url, headers=headers)
+    response = session.get(custom_fields_url, timeout=REQUEST_TIMEOUT)
 
     if response.status_code != 200:
         logging.error(
-            f"Failed to get custom field {CUSTOM_FIELD_ID}: {response.status_code}"
+            "Failed to get custom field %s: %s", CUSTOM_FIELD_ID, response.status_code
         )
         return None
 
-    return response.json()
+    return orjson.loads(response.content)
 
 
-def get_count_of_documents_without_azure_ocr(headers, secrets):
+def azure_ocr_query(custom_field_id):
     """
-    Get the count of documents that don't have the Azure OCR Completed flag set to true
+    Build the custom field query matching documents without the Azure OCR flag
     """
-    logging.info("Querying for count of documents without Azure OCR")
+    return f'["OR",[[{custom_field_id},"exists","false"],[{custom_field_id},"exact","false"]]]'
 
-    # Get custom field
-    azure_ocr_field = get_custom_field(headers, secrets)
-    if not azure_ocr_field:
-        logging.error("Custom field 'Azure OCR Completed' not found")
-        raise Exception("Custom field 'Azure OCR Completed' not found. Exiting script.")
 
-    # Query for count of documents without the custom field set to true
+def get_document_ids_without_azure_ocr(session, secrets, custom_field_id):
+    """
+    List the IDs of all documents that don't have the Azure OCR Completed flag set
+    to true, so the library is only scanned once per run
+    """
+    logging.info("Querying for IDs of documents without Azure OCR")
+
     documents_url = f"{secrets['PAPERLESS_URL']}/api/documents/"
+    # Smallest documents first, so a run completes as many as possible before
+    # a large scan uses up the time budget. Paperless adds no tie-breaker to
+    # the ordering and many documents share a page count, so order by ID too
+    # to keep the pages stable.
     params = {
-        "ordering": "-added",
-        "page_size": 1,  # We only need the count
-        "custom_field_query": f'["OR",[[{azure_ocr_field["id"]},"exists","false"],[{azure_ocr_field["id"]},"exact","false"]]]',
+        "ordering": "page_count,id",
+        "page_size": ID_PAGE_SIZE,
+        "fields": "id",
+        "custom_field_query": azure_ocr_query(custom_field_id),
+        "page": 1,
     }
 
-    response = requests.get(documents_url, headers=headers, params=params)
+    document_ids = []
+    while True:
+        response = session.get(documents_url, params=params, timeout=REQUEST_TIMEOUT)
 
-    if response.status_code != 200:
-        logging.error(f"Failed to get documents: {response.status_code}")
-        return 0
+        if response.status_code != 200:
+            # Keep what was listed so far, the rest is found on the next run
+            logging.error(
+                "Failed to get documents: %s, listing cut short after %s documents",
+                response.status_code,
+                len(document_ids),
+            )
+            break
+
+        page = orjson.loads(response.content)
+        document_ids.extend(doc["id"] for doc in page["results"])
 
-    total_count = response.json()["count"]
-    logging.info(f"Total documents without Azure OCR flag: {total_count}")
-    return total_count
+        # Only use next to detect the last page. Paperless builds it from the
+        # request it sees behind the proxy, so it can be plain http or an
+        # internal host, and the session would send its credentials there.
+        if not page["next"]:
+            break
+        params["page"] += 1
 
+    # A document edited while listing can still move between pages, and one
+    # listed twice would be OCR'd and patched twice
+    document_ids = list(dict.fromkeys(document_ids))
 
-def get_documents_without_azure_ocr(headers, secrets):
+    logging.info("Found %s documents without Azure OCR flag", len(document_ids))
+    return document_ids
+
+
+def get_documents_without_azure_ocr(session, secrets, custom_field_id, document_ids):
     """
-    Query Paperless for documents that don't have the Azure OCR Completed flag set to true
+    Fetch the given documents from Paperless, skipping any that have had the Azure
+    OCR Completed flag set since their IDs were listed
     """
-    logging.info("Querying for documents without Azure OCR")
+    logging.info("Fetching %s documents without Azure OCR", len(document_ids))
 
-    # Get custom field
-    azure_ocr_field = get_custom_field(headers, secrets)
-    if not azure_ocr_field:
-        logging.error("Custom field 'Azure OCR Completed' not found")
-        raise Exception("Custom field 'Azure OCR Completed' not found. Exiting script.")
-
-    # Query for documents without the custom field set to true
-    logging.info(
-        f"Using query size of {BATCH_SIZE} to fetch documents without Azure OCR flag"
-    )
     documents_url = f"{secrets['PAPERLESS_URL']}/api/documents/"
     params = {
-        "ordering": "-added",
-        "page_size": BATCH_SIZE,
-        "custom_field_query": f'["OR",[[{azure_ocr_field["id"]},"exists","false"],[{azure_ocr_field["id"]},"exact","false"]]]',
+        "ordering": "page_count,id",
+        "page_size": len(document_ids),
+        "id__in": ",".join(str(document_id) for document_id in document_ids),
+        "custom_field_query": azure_ocr_query(custom_field_id),
     }
 
-    response = requests.get(documents_url, headers=headers, params=params)
+    response = session.get(documents_url, params=params, timeout=REQUEST_TIMEOUT)
 
     if response.status_code != 200:
-        logging.error(f"Failed to get documents: {response.status_code}")
+        logging.error("Failed to get documents: %s", response.status_code)
         return []
 
-    documents_to_process = response.json()["results"]
-    if not documents_to_process:
-        logging.info("No documents found without Azure OCR flag")
-        return [], azure_ocr_field["id"]
-
-    logging.info(f"Found {len(documents_to_process)} documents to process")
-    return documents_to_process, azure_ocr_field["id"]
+    return orjson.loads(response.content)["results"]
 
 
-def download_document(document_id, headers, secrets):
+def download_document(document_id, session, secrets):
     """
     Download the document file from Paperless
     """
     download_url = f"{secrets['PAPERLESS_URL']}/api/documents/{document_id}/download/"
-    response = requests.get(download_url, headers=headers)
+    response = session.get(download_url, timeout=REQUEST_TIMEOUT)
 
     if response.status_code != 200:
         logging.error(
-            f"Failed to download document {document_id}: {response.status_code}"
+            "Failed to download document %s: %s", document_id, response.status_code
         )
         return None
 
-    temp_path = f"/tmp/paperless_doc_{document_id}.pdf"
-    with open(temp_path, "wb") as f:
-        f.write(response.content)
+    return response.content
 
-    return temp_path
 
-
-def process_with_azure_ocr(file_path, document_intelligence_client):
+def process_with_azure_ocr(
+    document_id, document_bytes, document_intelligence_client, ocr_deadline
+):
     """
-    Process the document with Azure Document Intelligence
+    Process the document with Azure Document Intelligence, giving up if the
+    result is not ready by ocr_deadline (a time.monotonic() value)
     """
-    logging.info(f"Processing {file_path} with Azure OCR")
+    logging.info("Processing document %s with Azure OCR", document_id)
 
     try:
-        with open(file_path, "rb") as f:
-            document_bytes = f.read()
-
         poller = document_intelligence_client.begin_analyze_document(
             model_id="prebuilt-read",
             body=document_bytes,
         )
 
-        result = poller.result()
+        poller.wait(timeout=max(ocr_deadline - time.monotonic(), 0))
+        if not poller.done():
+            logging.error(
+                "Azure OCR for document %s did not finish within the time budget",
+                document_id,
+            )
+            return None
 
-        # Extract the text content
-        content = ""
-        for page in result.pages:
-            for line in page.lines:
-                content += f"{line.content}\n"
+        result = poller.result()
 
-        return content
+        # Extract the text content, building the list first lets join size the
+        # result in a single pass
+        lines = [line.content for page in result.pages for line in page.lines]
+        return "\n".join(lines)
     except Exception as e:
-        logging.error(f"Azure OCR processing error: {e}")
+        logging.error("Azure OCR processing error: %s", e)
         return None
 
 
-def update_document_content(document_id, content, custom_field_id, headers, secrets):
+def update_document_content(document_id, content, custom_field_id, session, secrets):
     """
     Update the content field in Paperless and set the Azure OCR flag
     """
-    logging.info(f"Updating document {document_id} with OCR content")
+    logging.info("Updating document %s with OCR content", document_id)
 
     update_url = f"{secrets['PAPERLESS_URL']}/api/documents/{document_id}/"
 
-    # First get the current document data
-    response = requests.get(update_url, headers=headers)
+    # Re-read only the custom fields right before writing, so fields edited
+    # while the document was being OCR'd are not overwritten
+    response = session.get(
+        update_url, params={"fields": "custom_fields"}, timeout=REQUEST_TIMEOUT
+    )
 
     if response.status_code != 200:
-        logging.error(f"Failed to get document {document_id}: {response.status_code}")
+        logging.error(
+            "Failed to get document %s: %s", document_id, response.status_code
+        )
         return False
 
-    doc_data = response.json()
-
-    # Update the content field
-    doc_data["content"] = content
-
-    # Set the custom field
-    custom_fields = []
-    field_exists = False
-
-    for field in doc_data.get("custom_fields", []):
-        if field["field"] == custom_field_id:
-            field_exists = True
-            custom_fields.append({"field": custom_field_id, "value": True})
-        else:
-            custom_fields.append(field)
-
-    if not field_exists:
-        custom_fields.append({"field": custom_field_id, "value": True})
+    # Keep the other custom fields and set the flag
+    custom_fields = [
+        field
+        for field in orjson.loads(response.content).get("custom_fields", [])
+        if field["field"] != custom_field_id
+    ]
+    custom_fields.append({"field": custom_field_id, "value": True})
 
     # Update the document
-    response = requests.patch(
+    response = session.patch(
         update_url,
-        headers=headers,
-        json={"content": content, "custom_fields": custom_fields},
+        timeout=REQUEST_TIMEOUT,
+        data=orjson.dumps({"content": content, "custom_fields": custom_fields}),
     )
 
     if response.status_code not in [200, 202]:
         logging.error(
-            f"Failed to update document {document_id}: {response.status_code} - {response.text}"
+            "Failed to update document %s: %s - %s",
+            document_id,
+            response.status_code,
+            response.text,
         )
         return False
 
-    logging.info(f"Successfully updated document {document_id}")
+    logging.info("Successfully updated document %s", document_id)
     return True
 
 
-def cleanup(file_path):
+def process_document(
+    doc, custom_field_id, document_intelligence_client, session, secrets, ocr_deadline
+):
     """
-    Remove temporary files
+    Download, OCR and update a single document
     """
-    if file_path and os.path.exists(file_path):
-        os.remove(file_path)
+    document_id = doc["id"]
+    logging.info("Processing document %s: %s", document_id, doc["title"])
+
+    try:
+        # Download the document
+        document_bytes = download_document(document_id, session, secrets)
+        if not document_bytes:
+            logging.error("Failed to download document %s", document_id)
+            return False
+
+        # Process with Azure OCR
+        content = process_with_azure_ocr(
+            document_id, document_bytes, document_intelligence_client, ocr_deadline
+        )
+        if not content:
+            logging.error("Failed to process document %s with Azure OCR", document_id)
+            return False
+
+        # Update the document in Paperless
+        success = update_document_content(
+            document_id, content, custom_field_id, session, secrets
+        )
+
+        if success:
+            logging.info("Successfully processed document %s", document_id)
+        else:
+            logging.warning("Failed to update document %s", document_id)
+
+        return success
+
+    except Exception as e:
+        logging.error("Error processing document %s: %s", document_id, e)
+        return False
 
 
 def process_documents(secrets):
@@ -236,61 +384,84 @@ def process_documents(secrets):
     Main processing function that accepts secrets as parameter
     """
     logging.info("Starting Paperless-NGX Azure OCR integration script")
+    deadline = time.monotonic() + MAX_RUNTIME_SECONDS
+    # Documents still in flight at the deadline are the largest ones, with the
+    # longest OCR polls. Cut their polls off halfway through the margin so the
+    # remaining time covers the Paperless update before the host timeout.
+    ocr_deadline = deadline + RUNTIME_MARGIN_SECONDS / 2
 
-    document_intelligence_client, headers = setup_clients(secrets)
-
-    while get_count_of_documents_without_azure_ocr(headers, secrets) > 0:
-        try:
-            # Get documents without Azure OCR
-            documents, custom_field_id = get_documents_without_azure_ocr(
-                headers, secrets
-            )
+    document_intelligence_client, session = setup_clients(secrets)
 
-            if not documents:
-                logging.info("No documents to process")
-                return
+    # The custom field does not change during a run, so resolve it once
+    azure_ocr_field = get_custom_field(session, secrets)
+    if not azure_ocr_field:
+        logging.error("Custom field 'Azure OCR Completed' not found")
+        raise Exception("Custom field 'Azure OCR Completed' not found. Exiting script.")
+    custom_field_id = azure_ocr_field["id"]
+
+    document_ids = get_document_ids_without_azure_ocr(session, secrets, custom_field_id)
+    if not document_ids:
+        logging.info("No documents to process")
+        return
+
+    submitted = 0
+    processed = 0
+    in_flight = set()
+
+    def collect(futures):
+        nonlocal processed
+        for future in futures:
+            in_flight.discard(future)
+            processed += future.result()
+
+    # Keep up to OCR_CONCURRENCY documents in flight and refill slots as they
+    # free up, so fetching and downloading the next documents overlaps with
+    # waiting on the Azure OCR poller instead of waiting for a whole batch.
+    # Rate limiting is left to the session's retry backoff.
+    with ThreadPoolExecutor(max_workers=OCR_CONCURRENCY) as executor:
+        for start in range(0, len(document_ids), BATCH_SIZE):
+            if time.monotonic() >= deadline:
+                logging.info(
+                    "Time limit of %s seconds reached, remaining documents will "
+                    "be processed on the next run",
+                    MAX_RUNTIME_SECONDS,
+                )
+                break
+
+            try:
+                documents = get_documents_without_azure_ocr(
+                    session,
+                    secrets,
+                    custom_field_id,
+                    document_ids[start : start + BATCH_SIZE],
+                )
+            except Exception as e:
+                logging.error("Script execution error: %s", e)
+                break
 
-            # Process each document
             for doc in documents:
-                document_id = doc["id"]
-                logging.info(f"Processing document {document_id}: {doc['title']}")
-
-                try:
-                    # Download the document
-                    file_path = download_document(document_id, headers, secrets)
-                    if not file_path:
-                        logging.error(f"Failed to download document {document_id}")
-                        continue
-
-                    # Process with Azure OCR
-                    content = process_with_azure_ocr(
-                        file_path, document_intelligence_client
+                if time.monotonic() >= deadline:
+                    break
+
+                if len(in_flight) >= OCR_CONCURRENCY:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                in_flight.add(
+                    executor.submit(
+                        process_document,
+                        doc,
+                        custom_field_id,
+                        document_intelligence_client,
+                        session,
+                        secrets,
+                        ocr_deadline,
                     )
-                    if not content:
-                        logging.error(
-                            f"Failed to process document {document_id} with Azure OCR"
-                        )
-                        cleanup(file_path)
-                        continue
-
-                    # Update the document in Paperless
-                    success = update_document_content(
-                        document_id, content, custom_field_id, headers, secrets
-                    )
-
-                    # Clean up
-                    cleanup(file_path)
+                )
+                submitted += 1
 
-                    if success:
-                        logging.info(f"Successfully processed document {document_id}")
-                    else:
-                        logging.warning(f"Failed to update document {document_id}")
+        collect(list(as_completed(in_flight)))
 
-                    # Sleep briefly to avoid overloading the API
-                    time.sleep(1)
-
-                except Exception as e:
-                    logging.error(f"Error processing document {document_id}: {e}")
-
-        except Exception as e:
-            logging.error(f"Script execution error: {e}")
+    logging.info(
+        "Processing complete: %s of %s documents processed", processed, submitted
+    )